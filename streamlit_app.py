@@ -11,16 +11,32 @@ Changes requested by user:
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import sqlite3
 from pathlib import Path
-import time, datetime, json
+import os, time, datetime, json, threading, html, itertools, hashlib, tempfile, shutil, uuid
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from openpyxl import load_workbook
+from openpyxl import load_workbook, Workbook
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 APP_DIR = Path(".")
 DB_PATH = APP_DIR / "database.db"
 XLSX_PATH = APP_DIR / "Indicadores_CPP1.xlsx"
 LOCK_PATH = APP_DIR / ".write_lock"
+CACHE_DIR = APP_DIR / "data_cache"  # parquet snapshots of the SQLite tables
+FILTER_COLS = ["Máquina", "Produto", "Turno", "Operador"]  # categorical in prod_df
+MOV_BATCH_SIZE = 64   # buffered movimentações are flushed at this many rows...
+MOV_IDLE_FLUSH = 2.0  # ...or after this many seconds without a new one
+EXCEL_DEBOUNCE = 2.0  # saves within this window share one workbook write
+MOV_PAGE_SIZE = 200   # rows per page of the movimentações history
+STATUS_OPTIONS = ["Em Injeção", "Quebra", "Setup", "Parada"]
+STATUS_COLORS = {"Em Injeção": "#28a745", "Quebra": "#dc3545", "Setup": "#ffc107"}  # anything else: grey
+ROWID = "_rowid"  # SQLite rowid, carried as the DataFrame index so edits can be diffed
 
 st.set_page_config(page_title="Produção & Estoque - Dashboard v4", layout="wide")
 st.markdown(
@@ -30,6 +46,8 @@ st.markdown(
     div[data-testid="stMetricValue"] {font-size: 26px !important;}
     .metric-card {background: #f7fafc; border-radius: 12px; padding: 10px; text-align: center; box-shadow: 0 2px 5px rgba(0,0,0,0.05);}
     .status-dot {width:14px;height:14px;border-radius:50%;display:inline-block;margin-right:6px;}
+    .status-grid {display:grid;grid-template-columns:repeat(2,1fr);gap:10px;margin-bottom:16px;}
+    .status-cell {background:#f7fafc;border-radius:12px;padding:10px;box-shadow:0 2px 5px rgba(0,0,0,0.05);}
     </style>
     ''',
     unsafe_allow_html=True
@@ -37,70 +55,540 @@ st.markdown(
 
 
 # ------------------ Helpers ------------------
+@st.cache_resource
+def get_file_lock():
+    # the fd lock excludes other processes, the threading.Lock other sessions of this one
+    fd = os.open(str(LOCK_PATH), os.O_CREAT | os.O_RDWR, 0o644)
+    return fd, threading.Lock()
+
+def lock_fd(fd):
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+
+def unlock_fd(fd):
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
 def with_lock(fn):
     def wrapper(*args, **kwargs):
-        while LOCK_PATH.exists():
-            time.sleep(0.05)
-        try:
-            LOCK_PATH.write_text("lock")
-            return fn(*args, **kwargs)
-        finally:
-            if LOCK_PATH.exists():
-                try:
-                    LOCK_PATH.unlink()
-                except:
-                    pass
+        fd, thread_lock = get_file_lock()
+        with thread_lock:
+            lock_fd(fd)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                unlock_fd(fd)
     return wrapper
 
-@with_lock
+def from_sql_value(v, sql_type):
+    # dates/times are stored as text; give them back to Excel as real date cells
+    if isinstance(v, str) and sql_type in ("TIMESTAMP", "DATE", "TIME"):
+        try:
+            return (datetime.time if sql_type == "TIME" else datetime.datetime).fromisoformat(v)
+        except ValueError:
+            pass
+    return v
+
+def read_rows(table):
+    # header + rows straight off a cursor; a private read-only connection reads its own WAL snapshot
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+    try:
+        types = [r[2].upper() for r in conn.execute(f"PRAGMA table_info([{table}])")]
+        cur = conn.execute(f"SELECT * FROM [{table}]")
+        yield tuple(d[0] for d in cur.description)
+        for row in cur:
+            yield tuple(from_sql_value(v, t) for v, t in zip(row, types))
+    finally:
+        conn.close()
+
+def excel_rows(source):
+    # header + plain value tuples, so openpyxl streams them with ws.append; a str is a table name
+    if isinstance(source, str):
+        yield from read_rows(source)
+        return
+    yield tuple(source.columns)
+    for row in source.itertuples(index=False, name=None):
+        yield tuple(None if pd.isna(v) else v for v in row)
+
+def replace_file(path, write):
+    # write a sibling temp file, then swap it in: lock-free readers see the old or the new file, never half
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    os.close(fd)
+    try:
+        if path.exists():
+            shutil.copymode(path, tmp)
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
 def write_excel_sheets(sheet_dfs: dict):
-    # writes/overwrites the given sheets into the Excel file, preserving others
+    # writes/overwrites the given sheets (DataFrame or table name) into the Excel file, preserving others;
+    # caller holds the file lock
     if not XLSX_PATH.exists():
-        with pd.ExcelWriter(XLSX_PATH, engine="openpyxl") as writer:
-            for name, df in sheet_dfs.items():
-                df.to_excel(writer, sheet_name=name, index=False)
+        wb = Workbook(write_only=True)
+        for name, df in sheet_dfs.items():
+            ws = wb.create_sheet(name)
+            for row in excel_rows(df):
+                ws.append(row)
+        replace_file(XLSX_PATH, wb.save)
         return
     wb = load_workbook(XLSX_PATH)
-    # remove sheets to overwrite
-    for name in list(sheet_dfs.keys()):
+    for name, df in sheet_dfs.items():
+        # recreate the sheet at the same position, untouched sheets are saved as-is
+        pos = None
         if name in wb.sheetnames:
-            std = wb[name]
-            wb.remove(std)
-    wb.save(XLSX_PATH)
-    with pd.ExcelWriter(XLSX_PATH, engine="openpyxl", mode="a") as writer:
-        for name, df in sheet_dfs.items():
-            df.to_excel(writer, sheet_name=name, index=False)
+            pos = wb.sheetnames.index(name)
+            wb.remove(wb[name])
+        ws = wb.create_sheet(name, pos)
+        for row in excel_rows(df):
+            ws.append(row)
+    replace_file(XLSX_PATH, wb.save)
+    load_sheet_names.clear()  # entries for the previous mtime are dead weight now
+
+@st.cache_resource
+def get_excel_executor():
+    # single worker: workbook writes run in submission order, off the rerun
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="excel-writer")
+
+@st.cache_resource
+def get_excel_queue():
+    # sheets waiting for the next workbook write, shared by every session of the process
+    return {"lock": threading.Lock(), "sheets": {}, "future": None}
+
+def flush_excel_queue(queue):
+    time.sleep(EXCEL_DEBOUNCE)  # saves arriving meanwhile join this write
+    write_queued_sheets(queue)
+
+@with_lock
+def write_queued_sheets(queue):
+    # sheets are taken under the file lock: an upload either lands after this write or empties the queue first
+    with queue["lock"]:
+        sheet_dfs, queue["sheets"], queue["future"] = queue["sheets"], {}, None
+    if sheet_dfs:
+        write_excel_sheets(sheet_dfs)
+
+@with_lock
+def replace_workbook(data):
+    # an uploaded workbook replaces the file outright: sheets still queued from the DB must not overwrite it
+    queue = get_excel_queue()
+    with queue["lock"]:
+        queue["sheets"].clear()
+    replace_file(XLSX_PATH, lambda tmp: Path(tmp).write_bytes(data))
+    load_sheet_names.clear()
+
+def export_sheets(sheet_dfs: dict):
+    # write-behind: SQLite is the source of truth, the workbook follows at most once per EXCEL_DEBOUNCE
+    get_file_lock()  # create the cached lock from the script thread
+    queue = get_excel_queue()
+    with queue["lock"]:
+        queue["sheets"].update(sheet_dfs)  # tables are read when the write runs, so it sees the latest state
+        if queue["future"] is None:
+            queue["future"] = get_excel_executor().submit(flush_excel_queue, queue)
+        st.session_state["pending_excel_write"] = queue["future"]
+
+@st.cache_data(ttl="10m", max_entries=4, show_spinner=False)
+def load_sheet_names(path, mtime):
+    # mtime is only part of the cache key; read_only only parses the workbook part, not the cells
+    wb = load_workbook(path, read_only=True)
+    try:
+        return wb.sheetnames
+    finally:
+        wb.close()
 
-def read_table(table):
-    conn = sqlite3.connect(DB_PATH)
+def excel_sheet_names():
+    if not XLSX_PATH.exists():
+        return []
+    return load_sheet_names(str(XLSX_PATH), XLSX_PATH.stat().st_mtime_ns)
+
+@st.cache_resource
+def get_conn():
+    # one connection per process; WAL lets readers proceed while a save is writing
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-20000")  # ~20 MB page cache, kept warm by the shared connection
+    return conn
+
+@st.cache_resource
+def get_db_lock():
+    # serializes writers on the shared connection across sessions/threads
+    return threading.Lock()
+
+@st.cache_resource
+def table_versions():
+    # shared by all sessions, like the st.cache_data entries keyed on it
+    return {}
+
+def table_version(table):
+    return table_versions().get(table, 0)
+
+def get_table(table):
+    return read_table(table, table_version(table))
+
+def bump_table_version(table):
+    versions = table_versions()
+    versions[table] = versions.get(table, 0) + 1
+
+def touch_table(conn, table):
+    # fresh change token, written inside the caller's write transaction; snapshots are keyed on it
+    conn.execute("CREATE TABLE IF NOT EXISTS table_tokens (tbl TEXT PRIMARY KEY, token TEXT)")
+    conn.execute("REPLACE INTO table_tokens (tbl, token) VALUES (?, ?)", (table, uuid.uuid4().hex))
+
+def table_token(conn, table):
+    try:
+        row = conn.execute("SELECT token FROM table_tokens WHERE tbl = ?", (table,)).fetchone()
+    except sqlite3.OperationalError:
+        return None  # no write has gone through touch_table yet
+    return row[0] if row else None
+
+@st.cache_data(ttl="5m", show_spinner=False)
+def read_table(table, version=0):
+    # version is only part of the cache key: bumped by every write to the table
+    conn = get_conn()
+    with get_db_lock():
+        token = table_token(conn, table)
+    path = CACHE_DIR / f"{table}.{token}.parquet"
     try:
-        df = pd.read_sql_query(f"SELECT * FROM [{table}]", conn)
+        if token and path.exists():
+            return pd.read_parquet(path)
     except Exception:
-        df = pd.DataFrame()
-    conn.close()
+        pass
+    # no snapshot for the current token: read SQLite and refresh it
+    with get_db_lock():
+        try:
+            with conn:
+                # one read transaction: the token names exactly the state the rows come from
+                conn.execute("BEGIN")
+                token = table_token(conn, table)
+                # records straight from the cursor: same frame as pd.read_sql_query, minus its per-value coercion pass
+                cur = conn.execute(f"SELECT rowid AS [{ROWID}], * FROM [{table}]")
+                df = pd.DataFrame.from_records(cur.fetchall(), columns=[d[0] for d in cur.description], index=ROWID)
+        except Exception:
+            return pd.DataFrame()
+        if not token:
+            return df
+        path = CACHE_DIR / f"{table}.{token}.parquet"
+        try:
+            CACHE_DIR.mkdir(exist_ok=True)
+            df.to_parquet(path, compression="zstd")
+            for old in CACHE_DIR.glob(f"{table}.*.parquet"):
+                if old != path:
+                    old.unlink(missing_ok=True)
+        except Exception:
+            pass
+    return df
+
+def coerce_producao(df):
+    # Coerce production date if present, kept as datetime64 so filters compare raw values
+    if "Data" in df.columns:
+        try:
+            df["Data"] = pd.to_datetime(df["Data"], errors="coerce")
+        except Exception:
+            pass
+    # filter columns as categories: isin/groupby work on integer codes
+    for col in FILTER_COLS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
     return df
 
+def decode_categories(df):
+    # back to plain values, so the data editor accepts values outside the categories
+    return df.astype({c: df[c].cat.categories.dtype for c in df.select_dtypes("category").columns})
+
+@st.cache_data(ttl="5m", show_spinner=False)
+def load_producao(version=0):
+    # "Data" is parsed once per table version, not on every rerun
+    return coerce_producao(read_table("producao", version))
+
+@st.cache_data(show_spinner=False)
+def producao_date_bounds(version=0):
+    data = load_producao(version).get("Data")
+    if data is None:
+        return None, None
+    bounds = data.agg(["min", "max"])
+    if bounds.isna().any():
+        return None, None
+    return bounds["min"].date(), bounds["max"].date()
+
+@st.cache_data(show_spinner=False)
+def producao_filter_options(version=0):
+    # categories are already unique and sorted
+    df = load_producao(version)
+    return {c: df[c].cat.categories.tolist() for c in FILTER_COLS if c in df.columns}
+
+def filter_producao(df, filter_key):
+    # filter_key = (date range or None, *selections in FILTER_COLS order); one mask, sliced once
+    dates, *selections = filter_key
+    # plain numpy masks: no index alignment on every AND or on the final slice
+    mask = np.ones(len(df), dtype=bool)
+    if dates:
+        # whole days: the end date includes rows with a time of day
+        start, end = pd.Timestamp(dates[0]), pd.Timestamp(dates[1]) + pd.Timedelta(days=1)
+        mask &= ((df["Data"] >= start) & (df["Data"] < end)).to_numpy()
+    for col, sel in zip(FILTER_COLS, selections):
+        if col in df.columns and sel:
+            # categorical: compare codes against the codes of the selected categories
+            codes = df[col].cat.categories.get_indexer(list(sel))
+            mask &= np.isin(df[col].cat.codes.to_numpy(), codes[codes >= 0])
+    return df.iloc[mask]
+
+KPI_AGGS = {"Realizado": "sum", "Eficiência": "mean", "Ciclos": "sum", "Kg Aparas": "sum", "Kg": "sum"}
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def producao_kpis(df_version, filter_key):
+    # every KPI card in one agg call over the filtered frame
+    df = filter_producao(load_producao(df_version), filter_key)
+    spec = {c: f for c, f in KPI_AGGS.items() if c in df.columns}
+    return df.agg(spec).to_dict() if spec else {}
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def agg_eff_by_op(df_version, filter_key):
+    df = filter_producao(load_producao(df_version), filter_key)
+    eff = df.groupby("Operador", as_index=False, sort=False, observed=True)["Eficiência"].mean().sort_values("Eficiência", ascending=False)
+    eff["Eficiência"] = eff["Eficiência"] * 100
+    return eff
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def agg_product_summary(df_version, filter_key):
+    df = filter_producao(load_producao(df_version), filter_key)
+    prod_sum = df.groupby("Produto", as_index=False, sort=False, observed=True).agg({"Programado":"sum","Realizado":"sum"})
+    prod_sum["Perda"] = (prod_sum["Programado"] - prod_sum["Realizado"]).clip(lower=0)
+    return prod_sum.sort_values("Programado", ascending=False)
+
+def sql_rows(df):
+    # column-wise conversion to sqlite-bindable values, zipped back into row tuples
+    cols = []
+    for _, col in df.items():
+        if pd.api.types.is_numeric_dtype(col):
+            cols.append(col.astype(object).where(col.notna(), None).tolist())
+        else:
+            cols.append([to_sql_value(v) for v in col.tolist()])
+    return list(zip(*cols))
+
+def replace_table_rows(conn, table, df):
+    # caller holds the db lock inside an open transaction; schema is only rebuilt when the columns change
+    existing = [r[1] for r in conn.execute(f"PRAGMA table_info([{table}])")]
+    if existing == [str(c) for c in df.columns]:
+        conn.execute(f"DELETE FROM [{table}]")
+    else:
+        conn.execute(f"DROP TABLE IF EXISTS [{table}]")
+        conn.execute(pd.io.sql.get_schema(df, table))
+    collist = ",".join(f"[{c}]" for c in df.columns)
+    marks = ",".join("?" * len(df.columns))
+    conn.executemany(f"INSERT INTO [{table}] ({collist}) VALUES ({marks})", sql_rows(df))
+    touch_table(conn, table)
+
 def write_table(table, df):
-    conn = sqlite3.connect(DB_PATH)
-    df.to_sql(table, conn, if_exists="replace", index=False)
-    conn.close()
+    conn = get_conn()
+    with get_db_lock():
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            replace_table_rows(conn, table, df)
+    bump_table_version(table)
+
+def to_sql_value(v):
+    # pandas/numpy scalars -> types sqlite3 binds, dates in the same text format as to_sql
+    if v is None or (not isinstance(v, (str, bytes)) and pd.isna(v)):
+        return None
+    if isinstance(v, datetime.date) and not isinstance(v, datetime.datetime):
+        v = datetime.datetime.combine(v, datetime.time())
+    if isinstance(v, datetime.datetime):
+        return v.isoformat(sep=" ")
+    if isinstance(v, datetime.time):
+        return v.strftime("%H:%M:%S.%f")
+    if hasattr(v, "item"):
+        return v.item()
+    return v
+
+def frame_digest(df):
+    # vectorized row hashes (index included: deletions count) folded into one small digest
+    h = hashlib.blake2b(repr(list(df.columns)).encode(), digest_size=16)
+    try:
+        h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    except TypeError:
+        return None  # unhashable cells: let the row diff decide
+    return h.digest()
+
+def editor_frame(df):
+    # the editor gets a RangeIndex (hide_index works, new rows need no key); rowid rides along as a column
+    return df.reset_index() if df.index.name == ROWID else df
+
+# passed to st.data_editor with editor_frame: the rowid column is kept in the data but never shown
+EDITOR_COLUMNS = {ROWID: None}
+
+def from_editor_frame(df, taken):
+    # back to the rowid index; added rows get placeholder keys outside `taken`, INSERT assigns the real ones
+    df = df.copy()
+    new = df[ROWID].isna().to_numpy()
+    start = int(taken.max()) + 1 if len(taken) else 1
+    df.loc[new, ROWID] = range(start, start + int(new.sum()))
+    return df.astype({ROWID: "int64"}).set_index(ROWID)
+
+def save_table_edits(table, before, after):
+    """Persist only the rows changed between `before` (as read by read_table) and `after`.
+
+    Both may be editor frames (see editor_frame). Returns False when there was nothing to write."""
+    if ROWID in before.columns:
+        before = before.set_index(ROWID)
+        after = from_editor_frame(after, before.index)
+    if before.empty and len(before.columns) == 0:
+        # table does not exist yet: nothing to diff against
+        write_table(table, after)
+        return True
+    digest = frame_digest(before)
+    if digest is not None and digest == frame_digest(after):
+        return False
+    cols = [c for c in after.columns if c in before.columns]
+    common = before.index.intersection(after.index)
+    deleted = before.index.difference(after.index)
+    added = after.index.difference(before.index)
+    b = before.loc[common, cols].astype(object)
+    a = after.loc[common, cols].astype(object)
+    changed = common[((a != b) & ~(a.isna() & b.isna())).any(axis=1).to_numpy()]
+    if not len(deleted) and not len(added) and not len(changed):
+        return False
+
+    collist = ",".join(f"[{c}]" for c in cols)
+    marks = ",".join("?" * len(cols))
+    updates = ",".join(f"[{c}]=excluded.[{c}]" for c in cols)
+    conn = get_conn()
+    with get_db_lock():
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(f"DELETE FROM [{table}] WHERE rowid=?", [(int(i),) for i in deleted])
+            conn.executemany(
+                f"INSERT INTO [{table}] (rowid,{collist}) VALUES (?,{marks}) ON CONFLICT(rowid) DO UPDATE SET {updates}",
+                [(int(i), *row) for i, row in zip(changed, sql_rows(after.loc[changed, cols]))],
+            )
+            conn.executemany(f"INSERT INTO [{table}] ({collist}) VALUES ({marks})", sql_rows(after.loc[added, cols]))
+            touch_table(conn, table)
+    bump_table_version(table)
+    return True
+
+def ensure_columns(conn, table, columns):
+    # create the table / add missing columns (SQLite column names are case-insensitive)
+    existing = {r[1].lower() for r in conn.execute(f"PRAGMA table_info([{table}])")}
+    if not existing:
+        conn.execute(f"CREATE TABLE [{table}] ({', '.join(f'[{c}]' for c in columns)})")
+        return
+    for c in columns:
+        if c.lower() not in existing:
+            conn.execute(f"ALTER TABLE [{table}] ADD COLUMN [{c}]")
+
+def register_movimentacoes(rows):
+    # rows of (sku, nome, qty, motivo, operador, data): history + stock totals in one transaction
+    conn = get_conn()
+    with get_db_lock():
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany('INSERT INTO movimentacao_injetados (sku,nome,qty,motivo,operador,data) VALUES (?,?,?,?,?,?)', rows)
+            ensure_columns(conn, "estoque_injetados", ["sku","nome","quantidade","unidade","local"])
+            for sku, nome, qty, *_ in rows:
+                updated = 0
+                if sku:
+                    updated = conn.execute('UPDATE estoque_injetados SET quantidade = COALESCE(quantidade, 0) + ? WHERE CAST(sku AS TEXT) = ?', (qty, str(sku))).rowcount
+                if not updated:
+                    conn.execute('INSERT INTO estoque_injetados (sku,nome,quantidade,unidade,local) VALUES (?,?,?,?,?)', (sku, nome, qty, "", ""))
+            touch_table(conn, "estoque_injetados")
+    bump_table_version("estoque_injetados")
+
+def flush_mov_buffer(sheet_name):
+    buffer = st.session_state.get("mov_buffer")
+    if not buffer:
+        return
+    register_movimentacoes(buffer)
+    st.session_state["mov_buffer"] = []
+    export_sheets({sheet_name: "estoque_injetados"})
+
+def mov_buffer_due():
+    buffer = st.session_state.get("mov_buffer")
+    if not buffer:
+        return False
+    return len(buffer) >= MOV_BATCH_SIZE or time.time() - st.session_state.get("mov_buffer_at", 0) >= MOV_IDLE_FLUSH
+
+def sheet_rows(ws):
+    # column names as pd.read_excel would give them, then a generator of bindable rows
+    rows = ws.iter_rows(values_only=True)
+    header = list(next(rows, ()))
+    while header and header[-1] is None:
+        header.pop()
+    columns, seen = [], {}
+    for i, h in enumerate(header):
+        name = f"Unnamed: {i}" if h is None else str(h)
+        n = seen.get(name, 0)
+        seen[name] = n + 1
+        columns.append(f"{name}.{n}" if n else name)
+    width = len(columns)
+
+    def values():
+        for row in rows:
+            row = row[:width]
+            if any(v is not None for v in row):
+                yield row + (None,) * (width - len(row))
+    return columns, values()
+
+# declared types as to_sql would pick them, so column affinities stay the same
+SQL_TYPES = ((bool, "INTEGER"), (int, "INTEGER"), (float, "REAL"), (datetime.datetime, "TIMESTAMP"),
+             (datetime.date, "DATE"), (datetime.time, "TIME"), (str, "TEXT"))
+
+def sql_type(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return ""
+    if all(isinstance(v, (int, float)) for v in values) and any(isinstance(v, float) for v in values):
+        return "REAL"
+    return next((t for cls, t in SQL_TYPES if isinstance(values[0], cls)), "")
+
+def import_sheet(conn, ws, table, sample=100):
+    # streams one worksheet into a fresh table; caller holds the db lock inside a transaction
+    columns, rows = sheet_rows(ws)
+    if not columns:
+        return False
+    head = list(itertools.islice(rows, sample))
+    types = [sql_type(col) for col in zip(*head)] if head else [""] * len(columns)
+    conn.execute(f"DROP TABLE IF EXISTS [{table}]")
+    conn.execute(f"CREATE TABLE [{table}] ({', '.join(f'[{c}] {t}'.rstrip() for c, t in zip(columns, types))})")
+    conn.executemany(
+        f"INSERT INTO [{table}] VALUES ({','.join('?' * len(columns))})",
+        (tuple(map(to_sql_value, row)) for row in itertools.chain(head, rows)),
+    )
+    touch_table(conn, table)
+    return True
 
 def init_db_from_excel(mapping):
-    conn = sqlite3.connect(DB_PATH)
-    for sheet, table in mapping.items():
-        try:
-            df = pd.read_excel(XLSX_PATH, sheet_name=sheet)
-        except Exception:
-            continue
-        df.to_sql(table, conn, if_exists="replace", index=False)
-    conn.close()
+    try:
+        wb = load_workbook(XLSX_PATH, read_only=True, data_only=True)
+    except Exception:
+        return
+    loaded = []
+    conn = get_conn()
+    try:
+        with get_db_lock():
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                for sheet, table in mapping.items():
+                    if sheet in wb.sheetnames and import_sheet(conn, wb[sheet], table):
+                        loaded.append(table)
+    finally:
+        wb.close()
+    for table in loaded:
+        bump_table_version(table)
 
 # ------------------ Detect sheets ------------------
 detected = []
 if XLSX_PATH.exists():
     try:
-        x = pd.ExcelFile(XLSX_PATH)
-        detected = x.sheet_names
+        detected = excel_sheet_names()
     except Exception:
         detected = []
 
@@ -120,13 +608,15 @@ for sx, tbl in default_mapping.items():
     val = sx if sx in detected else sx
     newname = st.sidebar.text_input(f"Sheet fonte para '{tbl}'", value=val, key="map_"+tbl)
     user_mapping[newname] = tbl
+table_to_sheet = {v: k for k, v in user_mapping.items()}
 
 st.sidebar.markdown("---")
 st.sidebar.header("Import / Export")
 uploaded = st.sidebar.file_uploader("Substituir arquivo Excel (opcional)", type=["xlsx","xls"])
-if uploaded is not None:
-    with open(XLSX_PATH, "wb") as f:
-        f.write(uploaded.getbuffer())
+if uploaded is not None and st.session_state.get("uploaded_xlsx") != uploaded.file_id:
+    # write each upload once: rewriting it on every rerun would keep invalidating the workbook cache
+    replace_workbook(uploaded.getbuffer())
+    st.session_state["uploaded_xlsx"] = uploaded.file_id
     st.sidebar.success("Arquivo Excel substituído. Recarregue para aplicar.")
 
 if st.sidebar.button("Sincronizar Excel → DB (forçar)"):
@@ -137,158 +627,150 @@ if st.sidebar.button("Sincronizar Excel → DB (forçar)"):
 if not DB_PATH.exists() and XLSX_PATH.exists():
     init_db_from_excel({k:v for k,v in user_mapping.items()})
 
-# Load tables
-tables = {}
-for sheet_name, table_name in user_mapping.items():
-    tables[table_name] = read_table(table_name)
-
-# Coerce production date if present
-prod_df = tables.get("producao", pd.DataFrame())
-if "Data" in prod_df.columns:
-    try:
-        prod_df["Data"] = pd.to_datetime(prod_df["Data"], errors="coerce").dt.date
-    except Exception:
-        pass
+# Buffered movimentações: flushed on any rerun once due, and before the session leaves their page
+inj_sheet = table_to_sheet.get("estoque_injetados", "Estoque Injetados")
+if st.session_state.get("mov_buffer") and (menu != "Estoque Injetados" or mov_buffer_due()):
+    flush_mov_buffer(inj_sheet)
 
 # ------------------ Produção ------------------
 if menu == "Produção":
     st.title("Produção — Dashboard")
-st.markdown("KPIs e visão rápida da produção.")
-left, right = st.columns([1,3], gap="large")
-    with left:
-        st.subheader("Filtros")
-        # date range
-        if "Data" in prod_df.columns:
-            min_date = pd.to_datetime(prod_df["Data"]).min().date() if not prod_df["Data"].isna().all() else None
-            max_date = pd.to_datetime(prod_df["Data"]).max().date() if not prod_df["Data"].isna().all() else None
-            date_range = st.date_input("Período", value=(min_date, max_date) if min_date and max_date else None)
-        else:
-            date_range = None
-        machines = sorted(prod_df["Máquina"].dropna().unique().tolist()) if "Máquina" in prod_df.columns else []
-        sel_machine = st.multiselect("Máquina", options=machines, default=machines)
-        products = sorted(prod_df["Produto"].dropna().unique().tolist()) if "Produto" in prod_df.columns else []
-        sel_product = st.multiselect("Produto", options=products, default=products)
-        turns = sorted(prod_df["Turno"].dropna().unique().tolist()) if "Turno" in prod_df.columns else []
-        sel_turn = st.multiselect("Turno", options=turns, default=turns)
-        # Funcionário filter
-        funcionarios = sorted(prod_df["Operador"].dropna().unique().tolist()) if "Operador" in prod_df.columns else []
-        sel_func = st.multiselect("Funcionário (Operador)", options=funcionarios, default=funcionarios)
-
-    with right:
-        df = prod_df.copy()
-        if df.empty:
-            st.info("Nenhum dado de produção disponível. Importe do Excel no sidebar ou sincronize.")
-        else:
-            # apply filters
-            if date_range and isinstance(date_range, tuple) and len(date_range)==2:
-                start, end = date_range
-                df = df[(pd.to_datetime(df["Data"]) >= pd.to_datetime(start)) & (pd.to_datetime(df["Data"]) <= pd.to_datetime(end))]
-            if "Máquina" in df.columns and sel_machine:
-                df = df[df["Máquina"].isin(sel_machine)]
-            if "Produto" in df.columns and sel_product:
-                df = df[df["Produto"].isin(sel_product)]
-            if "Turno" in df.columns and sel_turn:
-                df = df[df["Turno"].isin(sel_turn)]
-            if "Operador" in df.columns and sel_func:
-                df = df[df["Operador"].isin(sel_func)]
-
-            # KPIs
-            col1, col2, col3, col4 = st.columns(4)
-            total_prod = int(df["Realizado"].sum()) if "Realizado" in df.columns else 0
-            eficiencia_mean = float(df["Eficiência"].mean()) if "Eficiência" in df.columns and not df["Eficiência"].isna().all() else None
-            total_ciclos = int(df["Ciclos"].sum()) if "Ciclos" in df.columns else None
-            aparas = float(df["Kg Aparas"].sum()) if "Kg Aparas" in df.columns else None
-            
-# KPIs visuais (cards)
-total_prod = int(df["Realizado"].sum()) if "Realizado" in df.columns else 0
-eficiencia_mean = float(df["Eficiência"].mean()) if "Eficiência" in df.columns and not df["Eficiência"].isna().all() else None
-total_ciclos = int(df["Ciclos"].sum()) if "Ciclos" in df.columns else None
-aparas = float(df["Kg Aparas"].sum()) if "Kg Aparas" in df.columns else None
-
-k1, k2, k3, k4 = st.columns(4)
-k1.markdown(f"<div class='metric-card'><div>Total Produzido</div><div style='font-size:22px;font-weight:700'>{total_prod:,d}</div></div>", unsafe_allow_html=True)
-k2.markdown(f"<div class='metric-card'><div>Eficiência Média</div><div style='font-size:22px;font-weight:700'>{(eficiencia_mean*100):.2f}%</div></div>", unsafe_allow_html=True) if eficiencia_mean else k2.markdown("<div class='metric-card'>—</div>", unsafe_allow_html=True)
-k3.markdown(f"<div class='metric-card'><div>Total de Ciclos</div><div style='font-size:22px;font-weight:700'>{total_ciclos if total_ciclos else '—'}</div></div>", unsafe_allow_html=True)
-k4.markdown(f"<div class='metric-card'><div>Kg Aparas</div><div style='font-size:22px;font-weight:700'>{aparas:.2f if aparas else '—'}</div></div>", unsafe_allow_html=True)
-            # Totais de Kg
-total_kg_pecas = float(df["Kg"].sum()) if "Kg" in df.columns else None
-st.write("**Totais (Kg)**")
-st.write(f"Kg de Peças: {total_kg_pecas:.2f}" if total_kg_pecas is not None else "Kg de Peças: —")
-
-            # Observações
-            st.subheader("Apontamentos / Observações")
-            if "Observações" in df.columns:
-                obs = df[~df["Observações"].isna()][["Data","Máquina","Produto","Operador","Observações"]].copy()
-                if not obs.empty:
-                    st.dataframe(obs.sort_values("Data", ascending=False).reset_index(drop=True))
-                else:
-                    st.info("Nenhuma observação registrada no período.")
-            else:
-                st.info("Coluna 'Observações' não encontrada.")
-
-            # Efficiency by operator chart (percent)
-            st.subheader("Eficiência por Operador (%)")
-            if "Operador" in df.columns and "Eficiência" in df.columns:
-                eff = df.groupby("Operador", as_index=False)["Eficiência"].mean().sort_values("Eficiência", ascending=False)
-                eff["Eficiência"] = eff["Eficiência"] * 100
-                st.bar_chart(eff.set_index("Operador")["Eficiência"])
+
+    @st.fragment
+    def producao_page():
+        # filters, KPIs and the editor rerun on their own, not the sidebar or the whole script
+        prod_version = table_version("producao")
+        prod_df = load_producao(prod_version)
+        st.markdown("KPIs e visão rápida da produção.")
+        left, right = st.columns([1,3], gap="large")
+        with left:
+            st.subheader("Filtros")
+            # date range
+            if "Data" in prod_df.columns:
+                min_date, max_date = producao_date_bounds(prod_version)
+                date_range = st.date_input("Período", value=(min_date, max_date) if min_date and max_date else None)
             else:
-                st.info("Colunas 'Operador' e/ou 'Eficiência' não encontradas para gerar gráfico.")
-
-            # Product summary: Produto x Programado x Realizado x Perda
-            st.subheader("Resumo por Produto (Programado / Realizado / Perda)")
-            if "Produto" in df.columns and "Programado" in df.columns and "Realizado" in df.columns:
-                prod_sum = df.groupby("Produto", as_index=False).agg({"Programado":"sum","Realizado":"sum"})
-                prod_sum["Perda"] = (prod_sum["Programado"] - prod_sum["Realizado"]).clip(lower=0)
-                prod_sum = prod_sum.sort_values("Programado", ascending=False)
-                st.table(prod_sum.rename(columns={"Programado":"Programado","Realizado":"Realizado","Perda":"Perda"}))
+                date_range = None
+            options = producao_filter_options(prod_version)
+            machines = options.get("Máquina", [])
+            sel_machine = st.multiselect("Máquina", options=machines, default=machines)
+            products = options.get("Produto", [])
+            sel_product = st.multiselect("Produto", options=products, default=products)
+            turns = options.get("Turno", [])
+            sel_turn = st.multiselect("Turno", options=turns, default=turns)
+            # Funcionário filter
+            funcionarios = options.get("Operador", [])
+            sel_func = st.multiselect("Funcionário (Operador)", options=funcionarios, default=funcionarios)
+
+        with right:
+            df = prod_df
+            if df.empty:
+                st.info("Nenhum dado de produção disponível. Importe do Excel no sidebar ou sincronize.")
             else:
-                st.info("Colunas necessárias para resumo por produto não encontradas.")
-
-            # Tabela Produção (editable)
-            st.subheader("Tabela Produção")
-            edited = st.data_editor(df, num_rows="dynamic", use_container_width=True)
-
-            csv_data = df.to_csv(index=False).encode("utf-8")
-            st.download_button("Exportar Tabela Produção (CSV)", data=csv_data, file_name="tabela_producao_filtrada.csv", mime="text/csv")
-            if st.button("Salvar alterações na produção"):
-                write_table("producao", edited)
-                # write back to excel sheet (find sheet name mapping)
-                try:
-                    sheet_name = list(user_mapping.keys())[list(user_mapping.values()).index("producao")]
-                except Exception:
-                    sheet_name = "Produção - injeção+ Zamac"
-                write_excel_sheets({sheet_name: edited})
-                st.success("Produção salva no DB e Excel.")
+                # apply filters; the key also identifies the cached aggregations below
+                filter_key = (
+                    tuple(date_range) if date_range and isinstance(date_range, tuple) and len(date_range)==2 else None,
+                    tuple(sorted(sel_machine)), tuple(sorted(sel_product)), tuple(sorted(sel_turn)), tuple(sorted(sel_func)),
+                )
+                df = filter_producao(df, filter_key)
+
+                # KPIs visuais (cards)
+                kpis = producao_kpis(prod_version, filter_key)
+                total_prod = int(kpis.get("Realizado", 0))
+                eficiencia_mean = float(kpis["Eficiência"]) if pd.notna(kpis.get("Eficiência")) else None
+                total_ciclos = int(kpis["Ciclos"]) if "Ciclos" in kpis else None
+                aparas = float(kpis["Kg Aparas"]) if "Kg Aparas" in kpis else None
+
+                k1, k2, k3, k4 = st.columns(4)
+                k1.markdown(f"<div class='metric-card'><div>Total Produzido</div><div style='font-size:22px;font-weight:700'>{total_prod:,d}</div></div>", unsafe_allow_html=True)
+                k2.markdown(f"<div class='metric-card'><div>Eficiência Média</div><div style='font-size:22px;font-weight:700'>{(eficiencia_mean*100):.2f}%</div></div>", unsafe_allow_html=True) if eficiencia_mean else k2.markdown("<div class='metric-card'>—</div>", unsafe_allow_html=True)
+                k3.markdown(f"<div class='metric-card'><div>Total de Ciclos</div><div style='font-size:22px;font-weight:700'>{total_ciclos if total_ciclos else '—'}</div></div>", unsafe_allow_html=True)
+                k4.markdown(f"<div class='metric-card'><div>Kg Aparas</div><div style='font-size:22px;font-weight:700'>{f'{aparas:.2f}' if aparas else '—'}</div></div>", unsafe_allow_html=True)
+                # Totais de Kg
+                total_kg_pecas = float(kpis["Kg"]) if "Kg" in kpis else None
+                st.write("**Totais (Kg)**")
+                st.write(f"Kg de Peças: {total_kg_pecas:.2f}" if total_kg_pecas is not None else "Kg de Peças: —")
+
+                # Observações
+                st.subheader("Apontamentos / Observações")
+                if "Observações" in df.columns:
+                    obs = df[~df["Observações"].isna()][["Data","Máquina","Produto","Operador","Observações"]].copy()
+                    if not obs.empty:
+                        st.dataframe(obs.sort_values("Data", ascending=False).reset_index(drop=True))
+                    else:
+                        st.info("Nenhuma observação registrada no período.")
+                else:
+                    st.info("Coluna 'Observações' não encontrada.")
+
+                # Efficiency by operator chart (percent)
+                st.subheader("Eficiência por Operador (%)")
+                if "Operador" in df.columns and "Eficiência" in df.columns:
+                    eff = agg_eff_by_op(prod_version, filter_key)
+                    st.bar_chart(eff.set_index("Operador")["Eficiência"])
+                else:
+                    st.info("Colunas 'Operador' e/ou 'Eficiência' não encontradas para gerar gráfico.")
+
+                # Product summary: Produto x Programado x Realizado x Perda
+                st.subheader("Resumo por Produto (Programado / Realizado / Perda)")
+                if "Produto" in df.columns and "Programado" in df.columns and "Realizado" in df.columns:
+                    prod_sum = agg_product_summary(prod_version, filter_key)
+                    st.table(prod_sum.rename(columns={"Programado":"Programado","Realizado":"Realizado","Perda":"Perda"}))
+                else:
+                    st.info("Colunas necessárias para resumo por produto não encontradas.")
+
+                # Tabela Produção (editable)
+                st.subheader("Tabela Produção")
+                table_df = editor_frame(decode_categories(df))
+                edited = st.data_editor(table_df, num_rows="dynamic", use_container_width=True, hide_index=True, column_config=EDITOR_COLUMNS)
+
+                csv_data = df.to_csv(index=False).encode("utf-8")
+                st.download_button("Exportar Tabela Produção (CSV)", data=csv_data, file_name="tabela_producao_filtrada.csv", mime="text/csv")
+                if st.button("Salvar alterações na produção"):
+                    # the editor only shows the filtered rows: write the diff, export the full table
+                    if not save_table_edits("producao", table_df, edited):
+                        st.info("Sem alterações.")
+                    else:
+                        # write back to excel sheet (find sheet name mapping)
+                        try:
+                            sheet_name = table_to_sheet["producao"]
+                        except Exception:
+                            sheet_name = "Produção - injeção+ Zamac"
+                        export_sheets({sheet_name: "producao"})
+                        st.success("Produção salva no DB. A planilha Excel é atualizada em segundo plano.")
+
+    producao_page()
 
 # ------------------ Estoque MP ------------------
 elif menu == "Estoque MP":
     st.title("Estoque MP")
-    df_mp = tables.get("estoque_mp", pd.DataFrame(columns=["mp_id","mp_nome","quantidade","unidade","local"]))
-st.write("Edite o estoque MP abaixo:")
-    edited_mp = st.data_editor(df_mp, num_rows="dynamic", use_container_width=True)
+    df_mp = editor_frame(get_table("estoque_mp"))
+    st.write("Edite o estoque MP abaixo:")
+    edited_mp = st.data_editor(df_mp, num_rows="dynamic", use_container_width=True, hide_index=True, column_config=EDITOR_COLUMNS)
     if st.button("Salvar Estoque MP"):
-        write_table("estoque_mp", edited_mp)
-        try:
-            sheet_name = list(user_mapping.keys())[list(user_mapping.values()).index("estoque_mp")]
-        except Exception:
-            sheet_name = "Estoque MP"
-        write_excel_sheets({sheet_name: edited_mp})
-        st.success("Estoque MP salvo no DB e Excel.")
+        if not save_table_edits("estoque_mp", df_mp, edited_mp):
+            st.info("Sem alterações.")
+        else:
+            try:
+                sheet_name = table_to_sheet["estoque_mp"]
+            except Exception:
+                sheet_name = "Estoque MP"
+            export_sheets({sheet_name: "estoque_mp"})
+            st.success("Estoque MP salvo no DB. A planilha Excel é atualizada em segundo plano.")
 
 # ------------------ Estoque Injetados ------------------
 elif menu == "Estoque Injetados":
     st.title("Estoque Injetados")
     # Ensure movimentation table exists
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute('CREATE TABLE IF NOT EXISTS movimentacao_injetados (id INTEGER PRIMARY KEY AUTOINCREMENT, sku TEXT, nome TEXT, qty REAL, motivo TEXT, operador TEXT, data TEXT)')
-    conn.commit()
-    conn.close()
+    with get_db_lock():
+        get_conn().execute('CREATE TABLE IF NOT EXISTS movimentacao_injetados (id INTEGER PRIMARY KEY AUTOINCREMENT, sku TEXT, nome TEXT, qty REAL, motivo TEXT, operador TEXT, data TEXT)')
+        get_conn().execute('CREATE INDEX IF NOT EXISTS idx_mov_data ON movimentacao_injetados(data DESC)')
 
     # Totals per product (top area)
-    df_inj = tables.get("estoque_injetados", pd.DataFrame(columns=["sku","nome","quantidade","unidade","local"]))
+    df_inj = get_table("estoque_injetados")
     if not df_inj.empty and "sku" in df_inj.columns:
-        totals = df_inj.groupby(["sku","nome"], as_index=False)["quantidade"].sum()
+        # SQLite matches column names case-insensitively, the sheet may call it "Quantidade"
+        qty_col = next((c for c in df_inj.columns if c.lower() == "quantidade"), "quantidade")
+        totals = df_inj.groupby(["sku","nome"], as_index=False, sort=False)[qty_col].sum().rename(columns={qty_col: "quantidade"})
     else:
         totals = pd.DataFrame(columns=["sku","nome","quantidade"])
     st.subheader("Totalizador de Estoque por Produto")
@@ -303,79 +785,93 @@ elif menu == "Estoque Injetados":
         operador = st.text_input("Operador")
         submit_mov = st.form_submit_button("Registrar movimentação")
         if submit_mov:
-            conn = sqlite3.connect(DB_PATH)
-            conn.execute('INSERT INTO movimentacao_injetados (sku,nome,qty,motivo,operador,data) VALUES (?,?,?,?,?,?)', (sku,nome,float(qty),motivo,operador,datetime.datetime.now().isoformat()))
-            conn.commit()
-            conn.close()
-            # update totals in estoque_injetados table accordingly
-            df = read_table('estoque_injetados')
-            if df.empty:
-                df = pd.DataFrame(columns=["sku","nome","quantidade","unidade","local"])
-            if 'sku' in df.columns and sku:
-                mask = df['sku'].astype(str) == str(sku)
-                if mask.any():
-                    df.loc[mask, 'quantidade'] = df.loc[mask, 'quantidade'].astype(float) + float(qty)
-                else:
-                    newrow = {"sku":sku, "nome":nome, "quantidade":qty, "unidade":"", "local":""}
-                    df = pd.concat([df, pd.DataFrame([newrow])], ignore_index=True)
-            else:
-                newrow = {"sku":sku, "nome":nome, "quantidade":qty, "unidade":"", "local":""}
-                df = pd.concat([df, pd.DataFrame([newrow])], ignore_index=True)
-            write_table('estoque_injetados', df)
-            try:
-                sheet_name = list(user_mapping.keys())[list(user_mapping.values()).index("estoque_injetados")]
-            except Exception:
-                sheet_name = "Estoque Injetados"
-            write_excel_sheets({sheet_name: df})
-            st.success('Movimentação registrada e estoque atualizado.')
+            # buffered: written in batches by flush_mov_buffer
+            buffer = st.session_state.setdefault("mov_buffer", [])
+            buffer.append((sku, nome, float(qty), motivo, operador, datetime.datetime.now().isoformat()))
+            st.session_state["mov_buffer_at"] = time.time()
+            if len(buffer) >= MOV_BATCH_SIZE:
+                flush_mov_buffer(inj_sheet)
+            st.success('Movimentação registrada. O estoque é atualizado em instantes.')
 
     st.subheader('Histórico de Movimentações')
-    conn = sqlite3.connect(DB_PATH)
-    mov = pd.read_sql_query('SELECT * FROM movimentacao_injetados ORDER BY data DESC', conn)
-    conn.close()
+    # reads on the shared connection take the db lock: another session's open transaction would show through
+    with get_db_lock():
+        total_mov = get_conn().execute('SELECT COUNT(*) FROM movimentacao_injetados').fetchone()[0]
+    pages = max(1, -(-total_mov // MOV_PAGE_SIZE))
+    page = st.number_input("Página", min_value=1, max_value=pages, value=1, step=1)
+    with get_db_lock():
+        cur = get_conn().execute('SELECT * FROM movimentacao_injetados ORDER BY data DESC LIMIT ? OFFSET ?', (MOV_PAGE_SIZE, (page - 1) * MOV_PAGE_SIZE))
+        mov = pd.DataFrame.from_records(cur.fetchall(), columns=[d[0] for d in cur.description])
     st.dataframe(mov)
+    st.caption(f"{total_mov} movimentações — página {page} de {pages}")
 
 # ------------------ Apontamentos Online ------------------
 elif menu == "Apontamentos Online":
     st.title("Apontamentos Online")
-st.markdown("Atualize rapidamente o que está rodando por máquina. Status muda de cor visualmente.")
+    st.markdown("Atualize rapidamente o que está rodando por máquina. Status muda de cor visualmente.")
     machines = ["Oriente 45", "Oriente 35", "Himaco 80", "Himaco 40", "Jasot", "MG", "Máq. 1 (Zamac)", "Máq. 2 (Zamac)"]
 
-    # ensure table exists
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute('CREATE TABLE IF NOT EXISTS apontamentos (machine TEXT PRIMARY KEY, produto TEXT, operador TEXT, status TEXT, updated_at TEXT)')
-    conn.commit()
-    conn.close()
+    # ensure table exists, then load current status of every machine in one query
+    with get_db_lock():
+        conn = get_conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS apontamentos (machine TEXT PRIMARY KEY, produto TEXT, operador TEXT, status TEXT, updated_at TEXT)')
+        rows = {r[0]: r[1:] for r in conn.execute('SELECT machine, produto, operador, status, updated_at FROM apontamentos').fetchall()}
+
+    current = {}
+    for m in machines:
+        row = rows.get(m)
+        current[m] = (row[0] or "", row[1] or "", row[2] or "Em Injeção") if row else ("", "", "Em Injeção")
+
+    # status grid for every machine in a single markdown call, colored by status
+    cells = "".join(
+        f"<div class='status-cell'><b>{html.escape(m)}</b><br>"
+        f"<span class='status-dot' style='background:{STATUS_COLORS.get(status, '#6c757d')}'></span><b>{html.escape(status)}</b><br>"
+        f"<b>Produto:</b> {html.escape(prod)}<br><b>Operador:</b> {html.escape(oper)}</div>"
+        for m, (prod, oper, status) in current.items()
+    )
+    st.markdown(f"<div class='status-grid'>{cells}</div>", unsafe_allow_html=True)
 
     cols = st.columns(2)
     for i, m in enumerate(machines):
-        with cols[i%2]:
-            st.subheader(m)
-            # load current
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute('SELECT produto, operador, status, updated_at FROM apontamentos WHERE machine=?', (m,))
-            row = cur.fetchone()
-            conn.close()
-            prod = row[0] if row else ""
-            oper = row[1] if row else ""
-            status = row[2] if row else "Em Injeção"
-            updated = row[3] if row else ""
-            # color box based on status
-            color = "#28a745" if status=="Em Injeção" else ("#dc3545" if status=="Quebra" else ("#ffc107" if status=="Setup" else "#6c757d"))
-st.markdown(f"<div><span class='status-dot' style='background:{color}'></span><b>{status}</b></div>", unsafe_allow_html=True)
-st.write(f"**Produto:** {prod}")
-st.write(f"**Operador:** {oper}")
+        prod, oper, status = current[m]
+        with cols[i%2], st.expander(f"Atualizar {m}"):
             with st.form(f"form_{m}"):
                 p = st.text_input("Produto (código)", value=prod, key=f"prod_{m}")
                 o = st.text_input("Operador", value=oper, key=f"oper_{m}")
-                s = st.selectbox("Status", options=["Em Injeção", "Quebra", "Setup", "Parada"], index=0 if status=="Em Injeção" else 1, key=f"stat_{m}")
+                s = st.selectbox("Status", options=STATUS_OPTIONS, index=STATUS_OPTIONS.index(status) if status in STATUS_OPTIONS else 0, key=f"stat_{m}")
                 submit = st.form_submit_button("Atualizar")
                 if submit:
-                    conn = sqlite3.connect(DB_PATH)
-                    conn.execute('REPLACE INTO apontamentos (machine, produto, operador, status, updated_at) VALUES (?,?,?,?,?)', (m, p, o, s, datetime.datetime.now().isoformat()))
-                    conn.commit()
-                    conn.close()
+                    with get_db_lock():
+                        get_conn().execute('REPLACE INTO apontamentos (machine, produto, operador, status, updated_at) VALUES (?,?,?,?,?)', (m, p, o, s, datetime.datetime.now().isoformat()))
                     st.success("Apontamento atualizado.")
 
+future = st.session_state.get("pending_excel_write")
+if future is not None:
+    if not future.done():
+        st.sidebar.info("Gravando Excel em segundo plano...")
+    else:
+        del st.session_state["pending_excel_write"]
+        if future.exception() is not None:
+            st.sidebar.error(f"Falha ao gravar o Excel: {future.exception()}")
+        else:
+            st.sidebar.success("Excel atualizado.")
+
+@st.fragment(run_every=MOV_IDLE_FLUSH)
+def mov_buffer_status():
+    # not tied to a page: the idle flush keeps running until the buffer is written
+    if mov_buffer_due():
+        flush_mov_buffer(inj_sheet)
+        st.rerun()
+    buffer = st.session_state.get("mov_buffer")
+    if not buffer:
+        return
+    st.caption(f"{len(buffer)} movimentação(ões) aguardando gravação.")
+    if st.button("Gravar movimentações agora"):
+        flush_mov_buffer(inj_sheet)
+        st.rerun()
+
+if st.session_state.get("mov_buffer"):
+    with st.sidebar:
+        mov_buffer_status()
+
 st.sidebar.caption("Use com cuidado: gravação reescreve sheets no Excel. Faça backup antes de usar.")
\ No newline at end of file